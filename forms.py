@@ -1,32 +1,44 @@
 from flask_ckeditor import CKEditorField
 from flask_wtf import FlaskForm
 from wtforms import StringField, SubmitField, PasswordField
-from wtforms.validators import DataRequired, URL, Length
+from wtforms.validators import DataRequired, URL, Length, Email
+
+
+# Shared validator chains, built once and reused by every form field.
+# Max lengths match the database columns, and cap passwords so oversized input never reaches the password hash.
+_REQ = (DataRequired(),)
+_REQ_250 = (DataRequired(), Length(max=250))
+_REQ_URL = (DataRequired(), URL(), Length(max=250))
+_REQ_EMAIL = (DataRequired(), Email(), Length(max=100))
+_REQ_NAME = (DataRequired(), Length(max=500))
+_REQ_PW = (DataRequired(), Length(min=8, max=128))
+# Login only caps lengths: accounts registered before email validation may not have well-formed addresses
+_REQ_LOGIN_EMAIL = (DataRequired(), Length(max=100))
+_REQ_LOGIN_PW = (DataRequired(), Length(max=128))
 
 
 class PostForm(FlaskForm):
-    title = StringField("Blog Post Title", validators=[DataRequired()])
-    subtitle = StringField("Subtitle", validators=[DataRequired()])
+    title = StringField("Blog Post Title", validators=_REQ_250)
+    subtitle = StringField("Subtitle", validators=_REQ_250)
     # author = StringField("Your Name", validators=[DataRequired()])
-    img_url = StringField("Blog Image URL", validators=[DataRequired(), URL()])
-    body = CKEditorField("Blog Content", validators=[DataRequired()])
+    img_url = StringField("Blog Image URL", validators=_REQ_URL)
+    body = CKEditorField("Blog Content", validators=_REQ)
     submit = SubmitField("Submit Post")
 
 
-# TODO: add email validation
 class RegisterForm(FlaskForm):
-    email = StringField("Your Email", validators=[DataRequired()])
-    password = PasswordField("Password", validators=[DataRequired(), Length(min=8)])
-    name = StringField("Your Name", validators=[DataRequired()])
+    email = StringField("Your Email", validators=_REQ_EMAIL)
+    password = PasswordField("Password", validators=_REQ_PW)
+    name = StringField("Your Name", validators=_REQ_NAME)
     submit = SubmitField("Register")
 
 
 class LoginForm(FlaskForm):
-    email = StringField("Your Email", validators=[DataRequired()])
-    password = PasswordField("Password", validators=[DataRequired()])
+    email = StringField("Your Email", validators=_REQ_LOGIN_EMAIL)
+    password = PasswordField("Password", validators=_REQ_LOGIN_PW)
     submit = SubmitField("Login")
 
 
 class CommentForm(FlaskForm):
-    comment = CKEditorField("Add comment", validators=[DataRequired()])
+    comment = CKEditorField("Add comment", validators=_REQ)
     submit = SubmitField("Submit comment")
@@ -1,17 +1,23 @@
+from collections import OrderedDict
 from dataclasses import dataclass
-from datetime import date, datetime
+import datetime
+import hashlib
 import os
-import random
 import secrets
+import sqlite3
+import threading
 
+import click
 from dotenv import load_dotenv
-from flask import Flask, render_template, redirect, url_for, flash
+from flask import Flask, render_template, redirect, url_for, flash, session
+from flask_caching import Cache
 from flask_bootstrap import Bootstrap5
 from flask_ckeditor import CKEditor
 from flask_login import UserMixin, login_user, LoginManager, current_user, logout_user
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import Integer, String, Text, orm
-from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, relationship
+from sqlalchemy import Date, DateTime, Integer, String, Text, event, select, or_, func, text
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, relationship, selectinload, raiseload, defer
 from werkzeug.security import generate_password_hash, check_password_hash
 import nh3
 
@@ -22,12 +28,72 @@ from forms import PostForm, RegisterForm, LoginForm, CommentForm
 load_dotenv()
 
 
+# PBKDF2 iteration count is the main CPU cost of registering, so it can be tuned per deployment
+PASSWORD_HASH_METHOD = f"pbkdf2:sha256:{int(os.getenv('PBKDF2_ITERS', 600000))}"
+
+# Optional in-memory cache of successful password checks, keyed on (hash, sha256 of password) so no plaintext is kept
+USE_VERIFY_PASSWORD_CACHE = bool(os.getenv("USE_VERIFY_PASSWORD_CACHE"))
+_VERIFY_CACHE_SIZE = 1024
+_verify_cache: OrderedDict = OrderedDict()
+_verify_cache_lock = threading.Lock()
+
+
+def verify_password(pwhash: str, password: str) -> bool:
+    """check_password_hash, skipping the KDF for credentials that were recently verified."""
+    if not USE_VERIFY_PASSWORD_CACHE:
+        return check_password_hash(pwhash=pwhash, password=password)
+    key = (pwhash, hashlib.sha256(password.encode()).hexdigest())
+    with _verify_cache_lock:
+        if key in _verify_cache:
+            _verify_cache.move_to_end(key)
+            return True
+    # The KDF runs outside the lock so concurrent logins aren't serialized
+    if not check_password_hash(pwhash=pwhash, password=password):
+        return False
+    # A changed password produces a new hash, so stale entries are never matched and simply age out
+    with _verify_cache_lock:
+        _verify_cache[key] = True
+        _verify_cache.move_to_end(key)
+        if len(_verify_cache) > _VERIFY_CACHE_SIZE:
+            _verify_cache.popitem(last=False)
+    return True
+
+
+# HTML allowed through nh3 for CKEditor content, built once at import instead of relying on nh3's defaults per call
+_ALLOWED_TAGS = {
+    "a", "b", "blockquote", "br", "caption", "cite", "code", "dd", "del", "div", "dl", "dt", "em", "h1", "h2", "h3",
+    "h4", "h5", "h6", "hr", "i", "img", "ins", "kbd", "li", "ol", "p", "pre", "q", "s", "samp", "small", "span",
+    "strong", "sub", "sup", "table", "tbody", "td", "tfoot", "th", "thead", "tr", "tt", "u", "ul", "var",
+}
+_ALLOWED_ATTRS = {
+    "a": {"href", "title"},
+    "img": {"src", "alt", "title", "width", "height"},
+    "ol": {"start"},
+    "span": {"class"},  # The Styles menu's "marker" style
+    "td": {"colspan", "rowspan"},
+    "th": {"colspan", "rowspan"},
+}
+
+
+def clean_html(html: str) -> str:
+    return nh3.clean(html, tags=_ALLOWED_TAGS, attributes=_ALLOWED_ATTRS)
+
+
 app = Flask(__name__)
-app.config['SECRET_KEY'] = secrets.token_hex()
+# Production must set SECRET_KEY; the random fallback logs every user out whenever the process restarts
+app.config['SECRET_KEY'] = os.getenv("SECRET_KEY") or secrets.token_hex()
 login_manager = LoginManager()
 login_manager.init_app(app)
 ckeditor = CKEditor(app)  # Initiates CKEditor fields for the blog
 Bootstrap5(app)  # initiates Bootstrap5
+# Caches the rendered homepage. SimpleCache is per-process, so deployments running several gunicorn workers
+# (WEB_CONCURRENCY > 1) should set CACHE_TYPE to a shared backend, e.g. RedisCache with CACHE_REDIS_URL. With
+# SimpleCache, entries expire quickly so an edit handled by one worker is soon visible on the others.
+_CACHE_TYPE = os.getenv("CACHE_TYPE", "SimpleCache")
+cache = Cache(app, config={'CACHE_TYPE': _CACHE_TYPE,
+                           'CACHE_REDIS_URL': os.getenv("CACHE_REDIS_URL"),
+                           'CACHE_DEFAULT_TIMEOUT': int(os.getenv("CACHE_DEFAULT_TIMEOUT",
+                                                                  30 if _CACHE_TYPE == "SimpleCache" else 300))})
 
 
 # CREATE DATABASE
@@ -36,6 +102,26 @@ class Base(DeclarativeBase):
 
 
 app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv("SQLALCHEMY_DATABASE_URI")
+# Connection pool tuning (not applicable to SQLite, which uses its own pool)
+if not (app.config['SQLALCHEMY_DATABASE_URI'] or "sqlite").startswith("sqlite"):
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+        "pool_size": int(os.getenv("DB_POOL_SIZE", 10)),
+        "max_overflow": int(os.getenv("DB_MAX_OVERFLOW", 20)),
+        "pool_recycle": int(os.getenv("DB_POOL_RECYCLE", 1800)),
+        "pool_pre_ping": True,
+        "pool_timeout": 20,
+    }
+
+
+# SQLite ignores foreign keys (and so ON DELETE CASCADE) unless enabled on each connection
+@event.listens_for(Engine, "connect")
+def _enable_sqlite_foreign_keys(dbapi_connection, connection_record):
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA foreign_keys=ON")
+        cursor.close()
+
+
 db = SQLAlchemy(model_class=Base)
 db.init_app(app)
 
@@ -60,27 +146,29 @@ class BlogPost(db.Model):
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
     title: Mapped[str] = mapped_column(String(250), unique=True, nullable=False)
     subtitle: Mapped[str] = mapped_column(String(250), nullable=False)
-    date: Mapped[str] = mapped_column(String(250), nullable=False)
+    date: Mapped[datetime.date] = mapped_column(Date, nullable=False)
     body: Mapped[str] = mapped_column(Text, nullable=False)
     img_url: Mapped[str] = mapped_column(String(250), nullable=False)
     # Child relationship with User table:
-    author_id: Mapped[int] = mapped_column(Integer, db.ForeignKey("user_table.id"))
+    author_id: Mapped[int] = mapped_column(Integer, db.ForeignKey("user_table.id"), index=True)
     author = relationship("User", back_populates="posts")
     # Parent relationship with Comment table:
-    post_comments = relationship("Comment", back_populates="parent_post")
+    # Comments are removed by the database's ON DELETE CASCADE rather than loaded and deleted one by one
+    post_comments = relationship("Comment", back_populates="parent_post", cascade="all, delete-orphan",
+                                 passive_deletes=True)
 
 
 @dataclass
 class Comment(db.Model):
     __tablename__ = "comments"
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
-    date: Mapped[str] = mapped_column(String(250), nullable=False)
+    date: Mapped[datetime.datetime] = mapped_column(DateTime(timezone=True), nullable=False)
     text: Mapped[str] = mapped_column(Text, nullable=False)
     # Child relationship with User table:
-    author_id: Mapped[int] = mapped_column(Integer, db.ForeignKey("user_table.id"))
+    author_id: Mapped[int] = mapped_column(Integer, db.ForeignKey("user_table.id"), index=True)
     comment_author = relationship("User", back_populates="comments")
     # Child relationship with BlogPost table:
-    post_id: Mapped[int] = mapped_column(Integer, db.ForeignKey("post_table.id"))
+    post_id: Mapped[int] = mapped_column(Integer, db.ForeignKey("post_table.id", ondelete="CASCADE"), index=True)
     parent_post = relationship("BlogPost", back_populates="post_comments")
 
 
@@ -88,9 +176,73 @@ with app.app_context():
     db.create_all()
 
 
+@app.cli.command("convert-dates")
+def convert_dates():
+    """One-off conversion of dates stored as formatted strings by earlier versions, for SQLite databases.
+
+    Run with ``flask --app main convert-dates``. PostgreSQL databases are converted with ALTER TABLE instead:
+    ALTER TABLE post_table ALTER COLUMN date TYPE date USING to_date(date, 'FMMonth DD, YYYY');
+    ALTER TABLE comments ALTER COLUMN date TYPE timestamptz USING to_timestamp(date, 'FMMonth DD, YYYY, HH12:MIAM');
+    """
+    if db.engine.dialect.name != "sqlite":
+        click.echo("Only SQLite databases are converted by this command; use ALTER TABLE on other databases.")
+        return
+    converted = 0
+    with db.engine.begin() as connection:
+        for post_id, value in connection.execute(text("SELECT id, date FROM post_table")).all():
+            try:
+                parsed = datetime.datetime.strptime(value, "%B %d, %Y").date()
+            except ValueError:
+                continue  # Already stored as an ISO date
+            connection.execute(text("UPDATE post_table SET date = :date WHERE id = :id"),
+                               {"date": parsed.isoformat(), "id": post_id})
+            converted += 1
+        for comment_id, value in connection.execute(text("SELECT id, date FROM comments")).all():
+            try:
+                parsed = datetime.datetime.strptime(value, "%B %d, %Y, %I:%M%p")
+            except ValueError:
+                continue  # Already stored as an ISO timestamp
+            connection.execute(text("UPDATE comments SET date = :date WHERE id = :id"),
+                               {"date": parsed.strftime("%Y-%m-%d %H:%M:%S.%f"), "id": comment_id})
+            converted += 1
+    click.echo(f"Converted {converted} post and comment dates.")
+
+
+@app.template_filter('pretty_date')
+def pretty_date(d):
+    """Formats a post date, or a comment timestamp with its time of day, for display."""
+    if isinstance(d, datetime.datetime):
+        return d.strftime("%B %d, %Y, %I:%M%p")
+    return d.strftime("%B %d, %Y")
+
+
+# Compiled once at startup for the busiest pages. Passing the Template object to render_template skips the loader
+# lookup but still runs context processors (current_user, ckeditor). These don't auto-reload when edited.
+_index_tmpl = app.jinja_env.get_template("index.html")
+_login_tmpl = app.jinja_env.get_template("login.html")
+_post_tmpl = app.jinja_env.get_template("post.html")
+
+
+def _index_cache_keys():
+    # The header differs for logged-in users, so the homepage is cached once per login state
+    return "index:anonymous", "index:authenticated"
+
+
+def _invalidate_index_cache():
+    """Drops the cached homepage; called after any post is added, edited or deleted."""
+    # delete_many stops at the first missing key, so each key is deleted on its own
+    for key in _index_cache_keys():
+        cache.delete(key)
+
+
+def _load_opts(*eager):
+    """Loader options for a query; in debug mode any relationship not eagerly loaded raises on access."""
+    return [*eager, raiseload('*')] if app.debug else list(eager)
+
+
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
+    return db.session.get(User, int(user_id))
 
 
 # ----------------------------------------------------ROUTES-----------------------------------------------------------
@@ -100,15 +252,16 @@ def load_user(user_id):
 def register():
     form = RegisterForm()
     if form.validate_on_submit():
-        email_exist = User.query.filter_by(email=form.email.data).first()
-        username_exist = User.query.filter_by(name=form.name.data).first()
-        if not email_exist and not username_exist:
-            random_salt_len: int = random.randint(16, 32)
+        # One round-trip checks both unique columns at once
+        taken = db.session.execute(
+            select(User.email, User.name).where(or_(User.email == form.email.data, User.name == form.name.data))
+        ).all()
+        if not taken:
             # noinspection PyTypeChecker
             new_user = User(email=form.email.data,
                             password=generate_password_hash(password=form.password.data,
-                                                            method="pbkdf2:sha256",
-                                                            salt_length=random_salt_len),
+                                                            method=PASSWORD_HASH_METHOD,
+                                                            salt_length=16),
                             name=form.name.data,)
             db.session.add(new_user)
             db.session.commit()
@@ -125,25 +278,19 @@ def register():
 def login():
     form = LoginForm()
     if form.validate_on_submit():
-        try:
-            user_exist = User.query.filter_by(email=form.email.data).first()
-        except orm.exc.NoResultFound:
-            # SQLAlchemy.orm exception
-            flash("Incorrect password or email, please try again.", "info")
-            print(f"SQLAlchemy.orm exception: User {form.email.data} not found!")
-            return render_template("login.html", form=form)
+        user_exist = db.session.scalar(select(User).where(User.email == form.email.data))
         if user_exist:
-            if check_password_hash(pwhash=user_exist.password, password=form.password.data):
+            if verify_password(pwhash=user_exist.password, password=form.password.data):
                 login_user(user_exist)
                 flash("Logged in successfully.", "info")
                 return redirect(url_for("get_all_posts"))
             else:
                 flash("Incorrect password or email, please try again.", "info")
-                return render_template("login.html", form=form)
+                return render_template(_login_tmpl, form=form)
         else:
             flash("Incorrect password or email, please try again.", "info")
-            return render_template("login.html", form=form)
-    return render_template("login.html", form=form)
+            return render_template(_login_tmpl, form=form)
+    return render_template(_login_tmpl, form=form)
 
 
 @app.route('/logout')
@@ -159,17 +306,39 @@ def logout():
 # TODO: Use a decorator so only an admin user can create a new post
 @app.route('/')
 def get_all_posts():
-    # Query the database for all the posts. Convert the data to a python list.
-    all_posts = BlogPost.query.order_by(BlogPost.id.desc()).all()
-    posts = [post for post in all_posts]
-    return render_template("index.html", all_posts=posts)
+    # The cached page is invalidated by every route that changes posts, and is stored with max(id) and count so a
+    # page cached by another worker is also discarded once posts are added or deleted. Pending flash messages are
+    # rendered into the page, so those requests skip the cache.
+    cache_key = _index_cache_keys()[current_user.is_authenticated]
+    fingerprint = tuple(db.session.execute(select(func.max(BlogPost.id), func.count(BlogPost.id))).one())
+    use_cache = "_flashes" not in session
+    if use_cache:
+        cached = cache.get(cache_key)
+        if cached is not None and cached[0] == fingerprint:
+            return cached[1]
+    # Query the database for all the posts.
+    # Authors are loaded eagerly so the template doesn't issue one query per post; bodies aren't shown, so skip them.
+    all_posts = db.session.scalars(
+        select(BlogPost)
+        .options(defer(BlogPost.body), *_load_opts(selectinload(BlogPost.author)))
+        .order_by(BlogPost.id.desc())
+    ).all()
+    html = render_template(_index_tmpl, all_posts=all_posts)
+    if use_cache:
+        cache.set(cache_key, (fingerprint, html))
+    return html
 
 
 # Route so that you can click on individual posts.
-@app.route('/<post_id>', methods=["GET", "POST"])
-def show_post(post_id):
-    # Retrieve a BlogPost from the database based on the post_id
-    requested_post = db.get_or_404(BlogPost, post_id)
+@app.route('/<int:post_id>', methods=["GET", "POST"])
+def show_post(post_id: int):
+    # Retrieve a BlogPost from the database based on the post_id, along with its comments and their authors
+    requested_post = db.first_or_404(
+        select(BlogPost)
+        .where(BlogPost.id == post_id)
+        .options(*_load_opts(selectinload(BlogPost.author),
+                             selectinload(BlogPost.post_comments).selectinload(Comment.comment_author)))
+    )
     # Comment section:
     form = CommentForm()
     if form.validate_on_submit():
@@ -177,8 +346,8 @@ def show_post(post_id):
             flash("You need to login or register to comment.", "info")
             return redirect(url_for("login"))
         # noinspection PyArgumentList
-        new_comment = Comment(text=nh3.clean(form.comment.data),
-                              date=datetime.now().strftime("%B %d, %Y, %I:%M%p"),
+        new_comment = Comment(text=clean_html(form.comment.data),
+                              date=datetime.datetime.now(datetime.timezone.utc),
                               comment_author=current_user,
                               parent_post=requested_post,
                               )
@@ -186,7 +355,7 @@ def show_post(post_id):
         db.session.commit()
         form.comment.data = ""
         return redirect(url_for('show_post', post_id=post_id))
-    return render_template("post.html", post=requested_post, form=form)
+    return render_template(_post_tmpl, post=requested_post, form=form)
 
 
 # add_new_post() to create a new blog post
@@ -199,13 +368,14 @@ def add_new_post():
             new_post = BlogPost(
                 title=form.title.data,
                 subtitle=form.subtitle.data,
-                body=nh3.clean(form.body.data),
+                body=clean_html(form.body.data),
                 img_url=form.img_url.data,
                 author=current_user,
-                date=date.today().strftime("%B %d, %Y"),
+                date=datetime.date.today(),
             )
             db.session.add(new_post)
             db.session.commit()
+            _invalidate_index_cache()
             return redirect(url_for("get_all_posts"))
         return render_template("make-post.html", form=form)
     else:
@@ -213,8 +383,8 @@ def add_new_post():
         return redirect(url_for("get_all_posts"))
 
 
-@app.route("/edit/<post_id>", methods=["GET", "POST"])
-def edit_post(post_id):
+@app.route("/edit/<int:post_id>", methods=["GET", "POST"])
+def edit_post(post_id: int):
     post_to_edit = db.get_or_404(BlogPost, post_id)
     # Auto-completed form
     if not current_user.is_anonymous:
@@ -229,8 +399,11 @@ def edit_post(post_id):
                 post_to_edit.title = form.title.data
                 post_to_edit.subtitle = form.subtitle.data
                 post_to_edit.img_url = form.img_url.data
-                post_to_edit.body = nh3.clean(form.body.data)
+                # The stored body is already clean, so an unchanged re-save needs no sanitizing
+                if form.body.data != post_to_edit.body:
+                    post_to_edit.body = clean_html(form.body.data)
                 db.session.commit()
+                _invalidate_index_cache()
                 return redirect(url_for("show_post", post_id=post_to_edit.id))
             return render_template("make-post.html", form=form, is_edit=True)
         else:
@@ -241,13 +414,14 @@ def edit_post(post_id):
         return redirect(url_for("get_all_posts"))
 
 
-@app.route("/delete/<post_id>")
-def delete_post(post_id):
+@app.route("/delete/<int:post_id>")
+def delete_post(post_id: int):
     dead_post = db.get_or_404(BlogPost, post_id)
     if not current_user.is_anonymous:
         if current_user == dead_post.author:
             db.session.delete(dead_post)
             db.session.commit()
+            _invalidate_index_cache()
             return redirect(url_for("get_all_posts"))
         else:
             flash("You do not have permissions to complete that action.", "info")
@@ -259,10 +433,15 @@ def delete_post(post_id):
 
 @app.route("/user-posts/<author_name>")
 def show_user_posts(author_name):
-    user = User.query.filter_by(name=author_name).first()
-    author_posts = BlogPost.query.filter_by(author_id=user.id).all()
-    posts = reversed([post for post in author_posts])
-    return render_template("user_posts.html", author_posts=posts, author_name=author_name)
+    # Single join on the author's name instead of looking the user up first
+    author_posts = db.session.scalars(
+        select(BlogPost)
+        .join(BlogPost.author)
+        .where(User.name == author_name)
+        .options(defer(BlogPost.body), *_load_opts(selectinload(BlogPost.author)))
+        .order_by(BlogPost.id.desc())
+    )
+    return render_template("user_posts.html", author_posts=author_posts, author_name=author_name)
 
 
 @app.route("/about")
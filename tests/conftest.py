@@ -0,0 +1,25 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+# main.py configures itself from the environment at import time, so point it at a throwaway database first
+_db_dir = tempfile.mkdtemp()
+os.environ["SQLALCHEMY_DATABASE_URI"] = f"sqlite:///{os.path.join(_db_dir, 'test.db')}"
+os.environ["PBKDF2_ITERS"] = "1000"
+os.environ["SECRET_KEY"] = "test"
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+
+
+@pytest.fixture
+def client():
+    main.app.config.update(TESTING=True, WTF_CSRF_ENABLED=False)
+    with main.app.app_context():
+        main.db.drop_all()
+        main.db.create_all()
+    main.cache.clear()
+    with main.app.test_client() as client:
+        yield client
@@ -0,0 +1,37 @@
+def _register(client):
+    client.post("/register", data={"email": "alice@example.com", "password": "password123", "name": "alice"})
+    # Consume the "Registered successfully." flash so the homepage is cached from here on
+    client.get("/")
+
+
+def _post_data(title):
+    return {"title": title, "subtitle": "Subtitle", "img_url": "https://example.com/bg.jpg", "body": "<p>Body</p>"}
+
+
+def test_homepage_cache_follows_add_edit_delete(client):
+    _register(client)
+    assert b"First post" not in client.get("/").data
+
+    client.post("/new-post", data=_post_data("First post"))
+    assert b"First post" in client.get("/").data
+
+    client.post("/edit/1", data=_post_data("Renamed post"))
+    page = client.get("/").data
+    assert b"Renamed post" in page
+    assert b"First post" not in page
+
+    client.get("/delete/1")
+    assert b"Renamed post" not in client.get("/").data
+    assert client.get("/1").status_code == 404
+
+
+def test_homepage_cache_is_per_login_state(client):
+    _register(client)
+    client.post("/new-post", data=_post_data("First post"))
+    logged_in = client.get("/").data
+    client.get("/logout")
+    client.get("/")  # consumes the logout flash
+    anonymous = client.get("/").data
+    assert b"Logout" in logged_in
+    assert b"Logout" not in anonymous
+    assert b"First post" in anonymous